@@ -1,3 +1,6 @@
 from .core import Prestashop,Format
 from .exceptions import PrestaShopError,PrestaShopAuthenticationError
+from .writebehind import WriteBehindQueue
+from .sync import StockSync,SyncReport
+from .transport import Cassette,RecordingAdapter,ReplayAdapter,recording_session,replay_session
 from .version import __author__,__version__
\ No newline at end of file
@@ -9,6 +9,7 @@ Prestashop is a Python library to interact with PrestaShop's Web Service API.
 """
 import os
 from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 
 
 from http.client import HTTPConnection
@@ -17,12 +18,20 @@ from xml.parsers.expat import ExpatError
 
 from requests import Session
 from requests.models import PreparedRequest
+from requests.exceptions import RequestException
 
 from packaging import version
 
 from .exceptions import PrestaShopError,PrestaShopAuthenticationError
 from .utils import dict2xml
 from .utils import base64_to_tmpfile
+from .utils import result_rows
+
+
+# fields returned by the webservice that are refused on PUT
+_READ_ONLY_FIELDS = {
+    'products' : ('manufacturer_name','quantity'),
+}
 
 
 class Format(Enum):
@@ -115,6 +124,7 @@ class Prestashop():
     data_format = Format.JSON
     ps_version = ''
     proxies = None
+    patch_supported = True
 
 
 
@@ -244,7 +254,7 @@ class Prestashop():
         req.prepare_url(url , params)
         return req.url
 
-    def _exec(self,resource,_id=None,ids=None, method='GET',data=None,_headers=None,display=None,_filter=None,sort=None,limit=None):
+    def _exec(self,resource,_id=None,ids=None, method='GET',data=None,_headers=None,display=None,_filter=None,sort=None,limit=None,timeout=None):
         params = {}
 
         if self.lang:
@@ -287,7 +297,8 @@ class Prestashop():
                 method=method,
                 url=url,
                 data=data,
-                headers=headers
+                headers=headers,
+                timeout=timeout
             )
 
             if response.content == b'' and response.status_code == 200:
@@ -302,7 +313,8 @@ class Prestashop():
                 method=method,
                 url=url,
                 data=data,
-                headers=headers
+                headers=headers,
+                timeout=timeout
         )
 
         if response.content == b'' and response.status_code == 200:
@@ -371,7 +383,7 @@ class Prestashop():
 
         return self._exec(resource,_id,'GET',display=display)
 
-    def write(self,resource:str,data:dict):
+    def write(self,resource:str,data:dict,timeout:float=None):
         """update record from prestashop
 
         Args:
@@ -391,20 +403,79 @@ class Prestashop():
                         }
                     }
         )
+            timeout (float, optional): timeout of the request in seconds. Defaults to None.
 
         Returns:
             dict: the updated record.
         """
         data  = {'prestashop' : data}
         _data = dict2xml(data)
-        return self._exec(resource=resource,method='PUT',data=_data,display=None)
+        return self._exec(resource=resource,method='PUT',data=_data,display=None,timeout=timeout)
+
+    def patch(self,resource:str,data:dict):
+        """partial update of record from prestashop, only the given fields are changed.
+        when the webservice of the shop does not support PATCH (405), the record is read,
+        merged with the given fields and sent back with PUT.
+
+        Args:
+            resource (str): resource to update ( taxes,customers,products ...)
+            data (dict): data in dict format with the id and the changed fields (
+                    data = {
+                        'product':{
+                            'id': 2,
+                            'price' : 9.90,
+                        }
+                    }
+        )
 
-    def unlink(self,resource:str,ids:list):
+        Returns:
+            dict: the updated record.
+        """
+        if self.patch_supported:
+            _data = dict2xml({'prestashop' : data})
+            try:
+                return self._exec(resource=resource,method='PATCH',data=_data,display=None)
+            except PrestaShopError as err:
+                if err.error_code != 405:
+                    raise
+                self.patch_supported = False
+        return self._put_merged(resource,data)
+
+    def _put_merged(self,resource,data):
+        tag, fields = list(data.items())[0]
+        _id = fields['id']
+
+        # read the raw xml record, it is the format expected by PUT
+        params = {'language' : self.lang} if self.lang else {}
+        url = self._prepare('{}{}/{}'.format(self.url,resource,_id),params)
+        response = self.client.request(method='GET',url=url)
+        if response.status_code == 401:
+            self._error(response.status_code,None)
+        elif response.status_code != 200:
+            raise PrestaShopError('Cannot read {}/{}'.format(resource,_id),response.status_code)
+
+        root = self._parse(response.content)
+        record = root.find(tag)
+        for field in _READ_ONLY_FIELDS.get(resource,()):
+            node = record.find(field)
+            if node is not None:
+                record.remove(node)
+        for field, value in fields.items():
+            node = record.find(field)
+            if node is None:
+                node = ElementTree.SubElement(record,field)
+            node.text = str(value)
+
+        _data = ElementTree.tostring(root,encoding='UTF-8')
+        return self._exec(resource=resource,_id=_id,method='PUT',data=_data,display=None)
+
+    def unlink(self,resource:str,ids:list,timeout:float=None):
         """remove one or multiple records
 
         Args:
             resource (str): resource to search ( taxes,customers,products ...)
             ids (list[int] | tuple(int) | str): list|tuple|str of ids to remove. ([1,3,9] , [9] , '3')
+            timeout (float, optional): timeout of the request in seconds. Defaults to None.
 
         Returns:
             boolean: result of remove (True,False)
@@ -412,12 +483,98 @@ class Prestashop():
         if isinstance(ids , (tuple,list)):
             resource_ids = ','.join([str(id) for id in ids])
             resource_ids = '[{}]'.format(resource_ids)
-            return self._exec(resource=resource ,ids=resource_ids, method='DELETE' , display=None)
+            return self._exec(resource=resource ,ids=resource_ids, method='DELETE' , display=None, timeout=timeout)
             
         else:
-            return self._exec(resource=resource ,ids=ids, method='DELETE' , display=None)
+            return self._exec(resource=resource ,ids=ids, method='DELETE' , display=None, timeout=timeout)
     
-    def create(self,resource:str,data:dict):
+    def bulk_unlink(self,resource:str,ids:list,shard_size:int=100,workers:int=4,timeout:float=None) -> dict:
+        """remove many records in parallel shards.
+        the ids of each shard are checked on the shop before the DELETE, when a shard fails
+        the ids still present are checked again then retried (split in half when nothing
+        was removed) until the bad ids are isolated.
+
+        Args:
+            resource (str): resource to remove ( carts,cart_rules ...)
+            ids (list[int] | tuple(int) | str): ids to remove. ([1,3,9] , [9] , '3')
+            shard_size (int, optional): ids removed per DELETE. Defaults to 100.
+            workers (int, optional): number of shards removed at the same time. Defaults to 4.
+            timeout (float, optional): timeout in seconds of each request. Defaults to None.
+
+        Returns:
+            dict: sets of str ids {'deleted': {...}, 'missing': {...}, 'failed': {...}}
+        """
+        if not isinstance(ids, (tuple, list, set)):
+            ids = [ids]
+        ids = list(dict.fromkeys(str(id) for id in ids))
+        shards = [ids[i:i + shard_size] for i in range(0, len(ids), shard_size)]
+        result = {'deleted': set(), 'missing': set(), 'failed': set()}
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            for shard_result in executor.map(lambda shard: self._unlink_shard(resource, shard, timeout), shards):
+                for key, shard_ids in shard_result.items():
+                    result[key].update(shard_ids)
+        return result
+
+    def _unlink_shard(self,resource,ids,timeout):
+        result = {'deleted': set(), 'missing': set(), 'failed': set()}
+        try:
+            existing = self._existing_ids(resource, ids, timeout)
+        except PrestaShopAuthenticationError:
+            raise
+        except (PrestaShopError, RequestException):
+            result['failed'].update(ids)
+            return result
+        result['missing'].update(id for id in ids if id not in existing)
+
+        pending = [[id for id in ids if id in existing]]
+        while pending:
+            shard = pending.pop()
+            if not shard:
+                continue
+            try:
+                resource_ids = '[{}]'.format(','.join(shard))
+                self._exec(resource=resource, ids=resource_ids, method='DELETE', display=None, timeout=timeout)
+            except PrestaShopAuthenticationError:
+                raise
+            except (PrestaShopError, RequestException) as err:
+                try:
+                    existing = self._existing_ids(resource, shard, timeout)
+                except PrestaShopAuthenticationError:
+                    raise
+                except (PrestaShopError, RequestException):
+                    result['failed'].update(shard)
+                    continue
+
+                gone = [id for id in shard if id not in existing]
+                remaining = [id for id in shard if id in existing]
+                # the shop refuses the whole DELETE when one id does not exist,
+                # so ids gone on a 404 were removed by someone else
+                if isinstance(err, PrestaShopError) and err.error_code == 404:
+                    result['missing'].update(gone)
+                else:
+                    result['deleted'].update(gone)
+
+                if not remaining:
+                    continue
+                if gone:
+                    pending.append(remaining)
+                elif len(remaining) == 1:
+                    result['failed'].update(remaining)
+                else:
+                    half = len(remaining) // 2
+                    pending.append(remaining[half:])
+                    pending.append(remaining[:half])
+            else:
+                result['deleted'].update(shard)
+        return result
+
+    def _existing_ids(self,resource,ids,timeout=None):
+        _filter = '[id]=[{}]'.format('|'.join(ids))
+        content = self._exec(resource=resource, method='GET', display='[id]', _filter=_filter, timeout=timeout)
+        return set(str(row['id']) for row in result_rows(content, resource))
+
+    def create(self,resource:str,data:dict,timeout:float=None):
         """create record 
 
         Args:
@@ -436,6 +593,7 @@ class Prestashop():
                         }
                     }
         )
+            timeout (float, optional): timeout of the request in seconds. Defaults to None.
 
         Returns:
             dict: record added.
@@ -444,7 +602,7 @@ class Prestashop():
 
         data  = {'prestashop' : data}
         _data = dict2xml(data)
-        return self._exec(resource=resource,data=_data,method='POST',display=None)
+        return self._exec(resource=resource,data=_data,method='POST',display=None,timeout=timeout)
 
     def create_binary(self,resource:str, file:str,_type:str = 'image',file_name=None):
         """create binary record
@@ -0,0 +1,371 @@
+# -*- coding: utf-8 -*-
+
+"""
+Stock and price synchronization for the PrestaShop webservice.
+
+:copyright: (c) 2023 Aymen Jemi
+:copyright: (c) 2023 AISYSNEXT
+:license: GPLv3, see LICENSE for more details
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from requests.exceptions import RequestException
+
+from .exceptions import PrestaShopError,PrestaShopAuthenticationError
+from .utils import result_rows
+
+
+# resource => (record tag, fields of the index, fields of the state)
+_RESOURCES = {
+    'products': ('product', '[id,reference,ean13]', '[id,price]'),
+    'combinations': ('combination', '[id,id_product,reference,ean13]', '[id,price]'),
+    'stock_availables': ('stock_available', '[id,id_product,id_product_attribute]', '[id,quantity]'),
+}
+
+
+class SyncReport():
+    """ Result of a `StockSync.sync` run
+
+    Attributes:
+        updated (dict): key => changed fields ({'quantity': 5, 'price': 9.9}).
+        skipped (list): keys already up to date.
+        unknown (list): keys not matching any reference or ean13 of the shop.
+        ambiguous (dict): key => records ('products/12', ...) sharing this reference or ean13.
+        failed (dict): key => error message (invalid feed value or rejected update).
+        partial (dict): key => {'applied': changed fields, 'error': message} when only
+        a part of the change was accepted.
+        duplicates (list): keys overridden by a later row of the feed for the same record.
+
+    Each key of the feed lands in exactly one of updated, skipped, unknown, ambiguous,
+    failed or partial (duplicates only informs about merged rows).
+    """
+
+    def __init__(self) -> None:
+        self.updated = {}
+        self.skipped = []
+        self.unknown = []
+        self.ambiguous = {}
+        self.failed = {}
+        self.partial = {}
+        self.duplicates = []
+
+    def summary(self) -> dict:
+        """ count of keys by outcome
+
+        Returns:
+            dict: {'updated': int, 'skipped': int, 'unknown': int, 'ambiguous': int,
+            'failed': int, 'partial': int, 'duplicates': int}
+        """
+        return {
+            'updated': len(self.updated),
+            'skipped': len(self.skipped),
+            'unknown': len(self.unknown),
+            'ambiguous': len(self.ambiguous),
+            'failed': len(self.failed),
+            'partial': len(self.partial),
+            'duplicates': len(self.duplicates),
+        }
+
+    def __repr__(self):
+        return '<SyncReport {}>'.format(self.summary())
+
+
+class StockSync():
+    """ Push quantities and prices of many products at once, only the values
+    that differ from the last known state of the shop are sent.
+
+    Products and combinations are indexed by reference and ean13. The index
+    is loaded in a few paginated searches (and optionally cached in a JSON
+    file) instead of one request per SKU. Current prices and quantities are
+    read again at the start of each sync, then each real change is sent as
+    a small PATCH from a pool of workers.
+    When a product and one of its combinations share a key, the combination wins,
+    other keys shared by several records are reported as ambiguous. The quantity
+    of a product with combinations is computed by the shop, so it is reported as
+    failed and only the quantities of its combinations can be synced.
+    Rows of the feed matching the same record are merged, the last value wins.
+
+    Example:
+
+    from prestashop import Prestashop, StockSync
+
+    api = Prestashop(url = "https://myprestashop.com", api_key="...")
+
+    sync = StockSync(api, cache_path='index.json', workers=8)
+
+    feed = [
+        ('demo_1', 10, 23.9),       # reference, quantity, price
+        ('3760001234567', 0, None), # ean13, quantity, price unchanged
+    ]
+
+    report = sync.sync(feed)
+    print(report.summary())
+    """
+
+    def __init__(self,api,cache_path:str=None,workers:int=8,page_size:int=1000) -> None:
+        """ StockSync class
+
+        Args:
+            api (Prestashop): client used to read the index and send the changes.
+            cache_path (str, optional): JSON file caching the key => id index between runs,
+            call `refresh_index` when products are added or references change. Defaults to None.
+            workers (int, optional): number of parallel requests. Defaults to 8.
+            page_size (int, optional): records fetched per search while indexing. Defaults to 1000.
+        """
+        self.api = api
+        self.cache_path = cache_path
+        self.workers = workers
+        self.page_size = page_size
+
+        self._lock = threading.Lock()
+        self._index = None
+
+    def refresh_index(self):
+        """ reload the index from the shop, the cache file is rewritten """
+        matches = {}
+        records = {}
+        stocks = {}
+        for row in self._search('stock_availables', 1):
+            stocks.setdefault((str(row['id_product']), str(row['id_product_attribute'])), row)
+
+        for resource in ('products', 'combinations'):
+            for row in self._search(resource, 1):
+                if resource == 'products':
+                    stock = stocks.get((str(row['id']), '0'))
+                else:
+                    stock = stocks.get((str(row['id_product']), str(row['id'])))
+                record_key = '{}/{}'.format(resource, row['id'])
+                records[record_key] = {
+                    'resource': resource,
+                    'id': str(row['id']),
+                    'stock_id': str(stock['id']) if stock else None,
+                    'has_combinations': False,
+                }
+                if resource == 'combinations':
+                    product = records.get('products/{}'.format(row['id_product']))
+                    if product is not None:
+                        product['has_combinations'] = True
+                    records[record_key]['id_product'] = str(row['id_product'])
+                for field in ('reference', 'ean13'):
+                    key = row.get(field)
+                    if key:
+                        matches.setdefault(str(key), [])
+                        if record_key not in matches[str(key)]:
+                            matches[str(key)].append(record_key)
+
+        keys = {}
+        ambiguous = {}
+        for key, record_keys in matches.items():
+            record_key = _resolve(records, record_keys)
+            if record_key is None:
+                ambiguous[key] = record_keys
+            else:
+                keys[key] = record_key
+
+        with self._lock:
+            self._index = {'keys': keys, 'ambiguous': ambiguous, 'records': records}
+        self.save_index()
+
+    def load_index(self):
+        """ load the index from the cache file if any, else from the shop """
+        if self.cache_path and os.path.exists(self.cache_path):
+            with open(self.cache_path) as f:
+                index = json.load(f)
+            # cache written before these fields existed
+            if 'ambiguous' not in index or any(
+                'has_combinations' not in entry for entry in index['records'].values()
+            ):
+                self.refresh_index()
+                return
+            with self._lock:
+                self._index = index
+        else:
+            self.refresh_index()
+
+    def save_index(self):
+        """ write the index to the cache file (no-op without `cache_path`) """
+        if not self.cache_path or self._index is None:
+            return
+        with self._lock:
+            records = {
+                record_key: {
+                    field: entry[field] for field in ('resource', 'id', 'stock_id', 'has_combinations')
+                }
+                for record_key, entry in self._index['records'].items()
+            }
+            data = json.dumps({
+                'keys': self._index['keys'],
+                'ambiguous': self._index['ambiguous'],
+                'records': records,
+            })
+        tmp_path = self.cache_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            f.write(data)
+        os.replace(tmp_path, self.cache_path)
+
+    def sync(self,feed) -> SyncReport:
+        """ send the quantities and prices that changed
+
+        Args:
+            feed (iterable): (key, quantity, price) tuples, key is a reference or an ean13,
+            quantity or price None to leave it unchanged. The price is the `price` field
+            of the matched record (tax excluded price, or price impact of a combination).
+
+        Returns:
+            SyncReport: what was updated, skipped, unknown or failed
+        """
+        if self._index is None:
+            self.load_index()
+        self._load_state()
+
+        report = SyncReport()
+        rows = []
+        seen = set()
+        invalid = {}
+        for key, quantity, price in feed:
+            key = str(key)
+            record_key = self._index['keys'].get(key)
+            if record_key is None:
+                if key in self._index['ambiguous']:
+                    report.ambiguous[key] = self._index['ambiguous'][key]
+                elif key not in seen:
+                    report.unknown.append(key)
+                seen.add(key)
+                continue
+            try:
+                quantity = None if quantity is None else int(quantity)
+                price = None if price is None else round(float(price), 6)
+            except (TypeError, ValueError) as err:
+                invalid[key] = 'Invalid value: {}'.format(err)
+                continue
+            rows.append((key, record_key, quantity, price))
+        report.failed.update(invalid)
+
+        merged = {}
+        for key, record_key, quantity, price in rows:
+            # a key with an invalid row is reported failed as a whole
+            if key in invalid:
+                continue
+            if record_key in merged:
+                previous_key, previous_quantity, previous_price = merged.pop(record_key)
+                report.duplicates.append(previous_key)
+                if quantity is None:
+                    quantity = previous_quantity
+                if price is None:
+                    price = previous_price
+            merged[record_key] = (key, quantity, price)
+
+        changes = []
+        for record_key, (key, quantity, price) in merged.items():
+            entry = self._index['records'][record_key]
+            change = {}
+            if quantity is not None and quantity != entry['quantity']:
+                change['quantity'] = quantity
+            if price is not None and price != entry['price']:
+                change['price'] = price
+            if 'quantity' in change and entry['has_combinations']:
+                report.failed[key] = 'Quantity of a product with combinations is computed from its combinations'
+            elif change:
+                changes.append((key, entry, change))
+            else:
+                report.skipped.append(key)
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            results = executor.map(lambda item: self._push(*item), changes)
+            for (key, _, change), (applied, error) in zip(changes, results):
+                if error is None:
+                    report.updated[key] = applied
+                elif applied:
+                    report.partial[key] = {'applied': applied, 'error': error}
+                else:
+                    report.failed[key] = error
+
+        return report
+
+    def _load_state(self):
+        records = self._index['records']
+        by_stock = {}
+        for record_key, entry in records.items():
+            entry['price'] = None
+            entry['quantity'] = None
+            if entry['stock_id'] is not None:
+                by_stock[entry['stock_id']] = entry
+
+        for resource in ('products', 'combinations'):
+            for row in self._search(resource, 2):
+                entry = records.get('{}/{}'.format(resource, row['id']))
+                if entry is not None:
+                    entry['price'] = _price(row.get('price'))
+
+        for row in self._search('stock_availables', 2):
+            entry = by_stock.get(str(row['id']))
+            if entry is not None:
+                entry['quantity'] = int(row['quantity'])
+
+    def _search(self,resource,fields):
+        display = _RESOURCES[resource][fields]
+        offset = 0
+        while True:
+            limit = '{},{}'.format(offset, self.page_size)
+            rows = result_rows(
+                self.api.search(resource, display=display, sort='[id_ASC]', limit=limit),
+                resource
+            )
+            yield from rows
+            if len(rows) < self.page_size:
+                return
+            offset += self.page_size
+
+    def _push(self,key,entry,change):
+        applied = {}
+        try:
+            if 'price' in change:
+                tag = _RESOURCES[entry['resource']][0]
+                self.api.patch(
+                    entry['resource'],
+                    {tag: {'id': entry['id'], 'price': change['price']}}
+                )
+                with self._lock:
+                    entry['price'] = change['price']
+                applied['price'] = change['price']
+            if 'quantity' in change:
+                if entry['stock_id'] is None:
+                    raise PrestaShopError('No stock available for {}'.format(key))
+                self.api.patch(
+                    'stock_availables',
+                    {'stock_available': {'id': entry['stock_id'], 'quantity': change['quantity']}}
+                )
+                with self._lock:
+                    entry['quantity'] = change['quantity']
+                applied['quantity'] = change['quantity']
+        except PrestaShopAuthenticationError:
+            raise
+        except (PrestaShopError, RequestException) as err:
+            return applied, str(err)
+        return applied, None
+
+
+def _resolve(records, record_keys):
+    """ record of a key, None when it is shared by unrelated records """
+    if len(record_keys) == 1:
+        return record_keys[0]
+    combinations = [
+        record_key for record_key in record_keys
+        if records[record_key]['resource'] == 'combinations'
+    ]
+    products = [record_key for record_key in record_keys if record_key not in combinations]
+    # a product and one of its combinations: the combination wins
+    if len(combinations) == 1 and len(products) == 1:
+        combination = records[combinations[0]]
+        if products[0] == 'products/{}'.format(combination['id_product']):
+            return combinations[0]
+    return None
+
+
+def _price(value):
+    if value in (None, ''):
+        return None
+    return round(float(value), 6)
@@ -0,0 +1,275 @@
+# -*- coding: utf-8 -*-
+
+"""
+Record and replay transport for the PrestaShop webservice.
+
+:copyright: (c) 2023 Aymen Jemi
+:copyright: (c) 2023 AISYSNEXT
+:license: GPLv3, see LICENSE for more details
+"""
+import base64
+import gzip
+import json
+import threading
+import time
+from datetime import timedelta
+
+from requests import Session
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.models import Response
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers
+
+from .exceptions import PrestaShopError
+
+
+# body is stored decoded, these headers would not match it anymore
+_SKIPPED_HEADERS = ('content-encoding', 'content-length', 'transfer-encoding')
+
+
+class Cassette():
+    """ Requests and responses exchanged with a shop, stored as gzipped
+    JSON lines. Only the method, the url and the response are kept, request
+    headers (credentials) and bodies are never written.
+
+    Example:
+
+    cassette = Cassette.load('shop.cassette')
+    print(len(cassette))
+    """
+
+    def __init__(self,interactions:list=None) -> None:
+        """ Cassette class
+
+        Args:
+            interactions (list, optional): recorded interactions. Defaults to None.
+        """
+        self.interactions = []
+        self._by_request = {}
+        self._lock = threading.Lock()
+        for interaction in interactions or []:
+            self.append(interaction)
+
+    def __len__(self):
+        return len(self.interactions)
+
+    @classmethod
+    def load(cls,path:str):
+        """ read a cassette file
+
+        Args:
+            path (str): path of the cassette
+
+        Returns:
+            Cassette: the loaded cassette
+        """
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return cls([json.loads(line) for line in f if line.strip()])
+
+    def save(self,path:str):
+        """ write the cassette file
+
+        Args:
+            path (str): path of the cassette
+        """
+        with self._lock:
+            interactions = list(self.interactions)
+        with gzip.open(path, 'wt', encoding='utf-8') as f:
+            for interaction in interactions:
+                f.write(json.dumps(interaction, separators=(',', ':')))
+                f.write('\n')
+
+    def append(self,interaction:dict):
+        """ add an interaction (dict with method, url, status, reason, headers, body, elapsed, offset) """
+        with self._lock:
+            self.interactions.append(interaction)
+            key = (interaction['method'], interaction['url'])
+            self._by_request.setdefault(key, []).append(interaction)
+
+    def record(self,request,response,elapsed:float,offset:float=0.0):
+        """ add the interaction of a sent request and its response
+
+        Args:
+            request (PreparedRequest): the sent request
+            response (Response): its response, with the content loaded
+            elapsed (float): seconds between sending the request and reading the whole response
+            offset (float, optional): seconds between the start of the recording and the request.
+            Defaults to 0.0.
+        """
+        headers = {
+            name: value for name, value in response.headers.items()
+            if name.lower() not in _SKIPPED_HEADERS
+        }
+        self.append({
+            'method': request.method,
+            'url': request.url,
+            'status': response.status_code,
+            'reason': response.reason,
+            'headers': headers,
+            'body': base64.b64encode(response.content).decode('ascii'),
+            'elapsed': elapsed,
+            'offset': offset,
+        })
+
+    def responses(self,method:str,url:str) -> list:
+        """ recorded interactions of one request, in recording order """
+        return self._by_request.get((method, url), [])
+
+
+class RecordingAdapter(HTTPAdapter):
+    """ Transport adapter sending the requests to the shop and recording
+    every exchange in a cassette, saved when the session is closed.
+    """
+
+    def __init__(self,cassette:Cassette=None,path:str=None,**kwargs) -> None:
+        """ RecordingAdapter class
+
+        Args:
+            cassette (Cassette, optional): cassette to record in. Defaults to a new one.
+            path (str, optional): where the cassette is saved on close. Defaults to None.
+        """
+        super().__init__(**kwargs)
+        self.cassette = cassette if cassette is not None else Cassette()
+        self.path = path
+        self._started = None
+
+    def send(self,request,**kwargs):
+        # Session.send sets response.elapsed only after the adapter returns
+        start = time.monotonic()
+        if self._started is None:
+            self._started = start
+        response = super().send(request, **kwargs)
+        response.content
+        elapsed = time.monotonic() - start
+        self.cassette.record(request, response, elapsed, start - self._started)
+        return response
+
+    def close(self):
+        super().close()
+        if self.path:
+            self.cassette.save(self.path)
+
+
+class ReplayAdapter(BaseAdapter):
+    """ Transport adapter serving the responses of a cassette without any
+    network access. Requests are matched on method and url, repeated
+    requests get the recorded responses in order.
+
+    Every adapter keeps its own position, so one loaded cassette can be
+    replayed by many sessions (threads) at the same time.
+    """
+
+    def __init__(self,cassette:Cassette,speed:float=None,loop:bool=False,keep_gaps:bool=False) -> None:
+        """ ReplayAdapter class
+
+        Args:
+            cassette (Cassette): cassette to replay.
+            speed (float, optional): replay the original timings divided by speed (1.0 for real time).
+            Defaults to None (full speed).
+            loop (bool, optional): start over when the responses of a request are exhausted.
+            Defaults to False.
+            keep_gaps (bool, optional): with a speed, also wait for the original delay between the
+            start of the recording and each request, measured from the first replayed request.
+            Defaults to False.
+        """
+        super().__init__()
+        self.cassette = cassette
+        self.speed = speed
+        self.loop = loop
+        self.keep_gaps = keep_gaps
+        self._positions = {}
+        self._started = None
+        self._lock = threading.Lock()
+
+    def send(self,request,**kwargs):
+        responses = self.cassette.responses(request.method, request.url)
+        key = (request.method, request.url)
+        with self._lock:
+            position = self._positions.get(key, 0)
+            if position >= len(responses) and self.loop:
+                position = 0
+            if position >= len(responses):
+                raise PrestaShopError(
+                    'No recorded response for {} {}'.format(request.method, request.url)
+                )
+            self._positions[key] = position + 1
+            if self._started is None:
+                self._started = time.monotonic()
+        interaction = responses[position]
+
+        if self.speed:
+            delay = interaction['elapsed'] / self.speed
+            if self.keep_gaps:
+                done = self._started + (interaction.get('offset', 0.0) + interaction['elapsed']) / self.speed
+                delay = max(delay, done - time.monotonic())
+            time.sleep(delay)
+
+        response = Response()
+        response.status_code = interaction['status']
+        response.reason = interaction['reason']
+        response.headers = CaseInsensitiveDict(interaction['headers'])
+        response.encoding = get_encoding_from_headers(response.headers)
+        response._content = base64.b64decode(interaction['body'])
+        response._content_consumed = True
+        response.elapsed = timedelta(seconds=interaction['elapsed'])
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        return response
+
+    def close(self):
+        pass
+
+
+def recording_session(path:str,session:Session=None) -> Session:
+    """ session recording its traffic in a cassette file (written on `session.close()`)
+
+    Args:
+        path (str): path of the cassette
+        session (Session, optional): session to record. Defaults to a new one.
+
+    Returns:
+        Session: session to give to Prestashop(session=...)
+
+    Example:
+
+    session = recording_session('shop.cassette')
+    api = Prestashop(url = "https://myprestashop.com", api_key="...", session=session)
+    api.search('products')
+    session.close()
+    """
+    if session is None:
+        session = Session()
+    adapter = RecordingAdapter(path=path)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def replay_session(cassette,speed:float=None,loop:bool=False,keep_gaps:bool=False) -> Session:
+    """ session answering from a cassette, no request reaches the network
+
+    Args:
+        cassette (Cassette | str): loaded cassette (to share between sessions) or path of the cassette
+        speed (float, optional): replay the original timings divided by speed. Defaults to None (full speed).
+        loop (bool, optional): start over when the responses of a request are exhausted. Defaults to False.
+        keep_gaps (bool, optional): with a speed, also reproduce the delays between requests. Defaults to False.
+
+    Returns:
+        Session: session to give to Prestashop(session=...)
+
+    Example:
+
+    cassette = Cassette.load('shop.cassette')
+    apis = [
+        Prestashop(url = "https://myprestashop.com", api_key="...", session=replay_session(cassette, loop=True))
+        for _ in range(50)
+    ]
+    """
+    if not isinstance(cassette, Cassette):
+        cassette = Cassette.load(cassette)
+    session = Session()
+    adapter = ReplayAdapter(cassette, speed=speed, loop=loop, keep_gaps=keep_gaps)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
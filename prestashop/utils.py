@@ -1,4 +1,5 @@
 from xml.dom.minidom import getDOMImplementation
+from xml.etree import ElementTree
 from builtins import str
 from past.types import basestring
 import base64
@@ -125,3 +126,30 @@ def base64_to_tmpfile(content,file_name):
     return path
 
 
+def result_rows(content, resource):
+    """
+    Flatten a list result of the webservice to a list of dict
+    @param content: result of a search (dict for JSON, Element for XML)
+    @param resource: resource searched (products, stock_availables ...)
+    @return: list of dict, one per record
+    """
+    if isinstance(content, dict):
+        rows = content.get(resource, [])
+        if isinstance(rows, dict):
+            rows = [rows]
+        return rows
+
+    # JSON answer of an empty search is an empty list, True for an empty body
+    if not isinstance(content, ElementTree.Element):
+        return []
+
+    node = content.find(resource)
+    if node is None:
+        node = content
+    rows = []
+    for record in node:
+        row = dict(record.attrib)
+        for field in record:
+            row[field.tag] = field.text or ''
+        rows.append(row)
+    return rows
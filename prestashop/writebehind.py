@@ -0,0 +1,393 @@
+# -*- coding: utf-8 -*-
+
+"""
+Durable write-behind queue for the PrestaShop webservice.
+
+:copyright: (c) 2023 Aymen Jemi
+:copyright: (c) 2023 AISYSNEXT
+:license: GPLv3, see LICENSE for more details
+"""
+import json
+import sqlite3
+import threading
+import time
+
+from requests.exceptions import ConnectionError
+
+from .exceptions import PrestaShopError
+
+
+# status codes that will never succeed on retry
+_PERMANENT_ERRORS = (400, 401, 404, 405)
+
+_UNKNOWN_CREATE = 'create may have been applied by the shop, check it before retry_failed()'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    op TEXT NOT NULL,
+    resource TEXT NOT NULL,
+    key TEXT,
+    payload TEXT,
+    version INTEGER NOT NULL DEFAULT 1,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try REAL NOT NULL DEFAULT 0,
+    error TEXT,
+    dead INTEGER NOT NULL DEFAULT 0,
+    sent INTEGER NOT NULL DEFAULT 0,
+    UNIQUE (op, resource, key)
+)
+"""
+
+
+class WriteBehindQueue():
+    """ Journal `write`, `create` and `unlink` calls locally and send them
+    to the shop from background workers.
+
+    Every call is appended to a SQLite journal and returns immediately.
+    Repeated updates of the same record (same resource and id) are merged
+    into one entry, the last data wins since `write` is a full PUT.
+    Unlinks of the same resource are sent together in one DELETE, split
+    when the shop refuses it to find the ids that cannot be removed.
+    Entries are removed from the journal only once the shop accepted them,
+    so a queue opened on an existing journal replays what is left after a
+    crash.
+
+    Writes and unlinks are idempotent and retried on any transient error.
+    A create is retried only when it surely did not reach the shop (connection
+    refused, 4xx answer). After a timeout, a 5xx answer or a crash while it was
+    sent, it is marked failed instead, since the record may already exist.
+
+    Example:
+
+    from prestashop import Prestashop, WriteBehindQueue
+
+    api = Prestashop(url = "https://myprestashop.com", api_key="...")
+
+    with WriteBehindQueue(api, 'prestashop.journal') as queue:
+        queue.write('stock_availables', {'stock_available': {'id': '7', ...}})
+        queue.unlink('carts', [3, 4])
+        # wait until the shop has everything
+        queue.flush()
+    """
+
+    def __init__(self,api,path:str,workers:int=2,batch_size:int=50,max_retries:int=5,retry_delay:float=1.0,poll_interval:float=0.5,timeout:float=60,autostart:bool=True) -> None:
+        """ WriteBehindQueue class
+
+        Args:
+            api (Prestashop): client used to send the journaled calls.
+            path (str): path of the SQLite journal (':memory:' for a volatile queue).
+            workers (int, optional): number of background workers. Defaults to 2.
+            batch_size (int, optional): max entries taken by a worker at once. Defaults to 50.
+            max_retries (int, optional): attempts before an entry is marked as failed. Defaults to 5.
+            retry_delay (float, optional): base delay in seconds, doubled on each retry. Defaults to 1.0.
+            poll_interval (float, optional): idle wait of workers in seconds. Defaults to 0.5.
+            timeout (float, optional): timeout of each request in seconds. Defaults to 60.
+            autostart (bool, optional): start the workers right away. Defaults to True.
+        """
+        self.api = api
+        self.path = path
+        self.workers = workers
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._in_flight = set()
+        self._threads = []
+        self._stopping = False
+
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        self._db.execute(_SCHEMA)
+
+        if autostart:
+            self.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """ Start the background workers, pending entries of the journal
+        (left by a previous run) are sent first.
+        """
+        with self._lock:
+            if self._threads:
+                return
+            self._stopping = False
+            for i in range(self.workers):
+                thread = threading.Thread(
+                    target=self._run,
+                    name='prestashop-writebehind-{}'.format(i),
+                    daemon=True
+                )
+                self._threads.append(thread)
+                thread.start()
+
+    def write(self,resource:str,data:dict):
+        """journal an update, merged with any pending update of the same record
+
+        Args:
+            resource (str): resource to update ( taxes,customers,products ...)
+            data (dict): data in dict format, same as `Prestashop.write`
+        """
+        key = self._record_id(data)
+        self._append('write', resource, key, data)
+
+    def create(self,resource:str,data:dict):
+        """journal a record creation
+
+        Args:
+            resource (str): resource to create ( taxes,customers,products ...)
+            data (dict): data in dict format, same as `Prestashop.create`
+        """
+        self._append('create', resource, None, data)
+
+    def unlink(self,resource:str,ids):
+        """journal the removal of one or multiple records,
+        pending updates of these records are dropped
+
+        Args:
+            resource (str): resource to remove ( taxes,customers,products ...)
+            ids (list[int] | tuple(int) | str): list|tuple|str of ids to remove. ([1,3,9] , [9] , '3')
+        """
+        if not isinstance(ids, (tuple, list)):
+            ids = [ids]
+        with self._lock:
+            with self._db:
+                for _id in ids:
+                    self._db.execute(
+                        'DELETE FROM journal WHERE op = ? AND resource = ? AND key = ? AND dead = 0',
+                        ('write', resource, str(_id))
+                    )
+                    self._upsert('unlink', resource, str(_id), None)
+            self._wakeup.notify_all()
+
+    def pending(self) -> int:
+        """ number of entries not yet accepted by the shop (failed ones excluded) """
+        with self._lock:
+            row = self._db.execute('SELECT COUNT(*) FROM journal WHERE dead = 0').fetchone()
+        return row[0]
+
+    def failed(self) -> list:
+        """ entries given up after `max_retries` attempts or a permanent error
+
+        Returns:
+            list: dicts with seq, op, resource, id, data and error
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT seq, op, resource, key, payload, error FROM journal WHERE dead = 1 ORDER BY seq'
+            ).fetchall()
+        return [
+            {
+                'seq': seq,
+                'op': op,
+                'resource': resource,
+                'id': key,
+                'data': json.loads(payload) if payload else None,
+                'error': error,
+            }
+            for seq, op, resource, key, payload, error in rows
+        ]
+
+    def retry_failed(self):
+        """ put the failed entries back in the queue """
+        with self._lock:
+            with self._db:
+                self._db.execute(
+                    'UPDATE journal SET dead = 0, attempts = 0, next_try = 0, error = NULL, sent = 0 WHERE dead = 1'
+                )
+            self._wakeup.notify_all()
+
+    def flush(self,timeout:float=None) -> bool:
+        """ block until every pending entry is sent or failed
+
+        Args:
+            timeout (float, optional): max wait in seconds. Defaults to None (no limit).
+
+        Returns:
+            bool: True if the queue is drained, False on timeout or when the workers are not started
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._lock:
+            if not self._threads:
+                return not (self._count_pending() or self._in_flight)
+            self._wakeup.notify_all()
+            while self._count_pending() or self._in_flight:
+                if deadline is None:
+                    wait = self.poll_interval
+                else:
+                    wait = min(self.poll_interval, deadline - time.monotonic())
+                    if wait <= 0:
+                        return False
+                self._wakeup.wait(wait)
+        return True
+
+    def close(self,timeout:float=None):
+        """ flush the queue, stop the workers and close the journal.
+        Entries not sent before the timeout stay in the journal for the next run.
+
+        Args:
+            timeout (float, optional): max wait of the flush in seconds. Defaults to None (no limit).
+        """
+        self.flush(timeout)
+        with self._lock:
+            self._stopping = True
+            self._wakeup.notify_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+        self._db.close()
+
+    def _record_id(self,data):
+        for value in data.values():
+            if isinstance(value, dict) and value.get('id') not in (None, ''):
+                return str(value['id'])
+        raise PrestaShopError('Record id is required to queue a write')
+
+    def _append(self,op,resource,key,data):
+        with self._lock:
+            with self._db:
+                self._upsert(op, resource, key, json.dumps(data))
+            self._wakeup.notify_all()
+
+    def _upsert(self,op,resource,key,payload):
+        # bumping the version tells a worker holding the old data not to drop the entry
+        self._db.execute(
+            'INSERT INTO journal (op, resource, key, payload) VALUES (?, ?, ?, ?) '
+            'ON CONFLICT (op, resource, key) DO UPDATE SET '
+            'payload = excluded.payload, version = version + 1, '
+            'attempts = 0, next_try = 0, error = NULL, dead = 0',
+            (op, resource, key, payload)
+        )
+
+    def _count_pending(self):
+        row = self._db.execute('SELECT COUNT(*) FROM journal WHERE dead = 0').fetchone()
+        return row[0]
+
+    def _claim(self):
+        rows = self._db.execute(
+            'SELECT seq, op, resource, key, payload, version, attempts, sent FROM journal '
+            'WHERE dead = 0 AND next_try <= ? ORDER BY seq',
+            (time.time(),)
+        )
+        batch = []
+        for row in rows:
+            if row[0] in self._in_flight:
+                continue
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                break
+        self._in_flight.update(row[0] for row in batch)
+        return batch
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._stopping:
+                    return
+                batch = self._claim()
+                if not batch:
+                    self._wakeup.wait(self.poll_interval)
+                    continue
+            try:
+                self._send(batch)
+            except Exception:
+                # journal not writable, the batch is claimed again on the next round
+                time.sleep(self.poll_interval)
+            finally:
+                with self._lock:
+                    self._in_flight.difference_update(row[0] for row in batch)
+                    self._wakeup.notify_all()
+
+    def _send(self,batch):
+        unlinks = {}
+        for row in batch:
+            seq, op, resource, key, payload, version, attempts, sent = row
+            if op == 'unlink':
+                unlinks.setdefault(resource, []).append(row)
+            elif op == 'write':
+                try:
+                    self.api.write(resource, json.loads(payload), timeout=self.timeout)
+                except Exception as err:
+                    self._failure([row], err)
+                else:
+                    self._success([row])
+            else:
+                self._send_create(row)
+
+        for resource, rows in unlinks.items():
+            self._send_unlink(resource, rows)
+
+    def _send_create(self,row):
+        seq, op, resource, key, payload, version, attempts, sent = row
+        if sent:
+            # the worker stopped after the POST, before the answer was journaled
+            self._failure([row], PrestaShopError(_UNKNOWN_CREATE), permanent=True)
+            return
+
+        with self._lock:
+            with self._db:
+                self._db.execute('UPDATE journal SET sent = 1 WHERE seq = ?', (seq,))
+        try:
+            self.api.create(resource, json.loads(payload), timeout=self.timeout)
+        except Exception as err:
+            refused = isinstance(err, PrestaShopError) and err.error_code is not None and err.error_code < 500
+            if refused or isinstance(err, ConnectionError):
+                self._failure([row], err)
+            else:
+                self._failure([row], PrestaShopError('{} ({})'.format(_UNKNOWN_CREATE, err)), permanent=True)
+        else:
+            self._success([row])
+
+    def _send_unlink(self,resource,rows):
+        try:
+            self.api.unlink(resource, [row[3] for row in rows], timeout=self.timeout)
+        except Exception as err:
+            if not (isinstance(err, PrestaShopError) and err.error_code == 404):
+                self._failure(rows, err)
+            elif len(rows) > 1:
+                # the shop refuses the whole DELETE when one id does not exist, isolate it
+                half = len(rows) // 2
+                self._send_unlink(resource, rows[:half])
+                self._send_unlink(resource, rows[half:])
+            else:
+                # already removed
+                self._success(rows)
+        else:
+            self._success(rows)
+
+    def _success(self,rows):
+        with self._lock:
+            with self._db:
+                for row in rows:
+                    self._db.execute(
+                        'DELETE FROM journal WHERE seq = ? AND version = ?',
+                        (row[0], row[5])
+                    )
+
+    def _failure(self,rows,err,permanent=False):
+        permanent = permanent or _is_permanent(err)
+        with self._lock:
+            with self._db:
+                for row in rows:
+                    seq, version, attempts = row[0], row[5], row[6] + 1
+                    dead = 1 if permanent or attempts >= self.max_retries else 0
+                    next_try = time.time() + self.retry_delay * 2 ** (attempts - 1)
+                    self._db.execute(
+                        'UPDATE journal SET attempts = ?, next_try = ?, error = ?, dead = ?, sent = 0 '
+                        'WHERE seq = ? AND version = ?',
+                        (attempts, next_try, str(err), dead, seq, version)
+                    )
+
+
+def _is_permanent(err):
+    return isinstance(err, PrestaShopError) and err.error_code in _PERMANENT_ERRORS